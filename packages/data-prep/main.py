@@ -38,6 +38,7 @@ This script performs the following steps:
      suitable for ML training pipelines.
 """
 
+import io
 import json
 import logging
 import os
@@ -52,6 +53,7 @@ from omegaconf import DictConfig
 from pydantic import ValidationError
 from src.app.jobs.models import Block, Chat, Message
 from src.app.jobs.utils import (
+    S3_TRANSFER_CONFIG,
     calculate_chat_stats,
     load_tokenizer,
     parse_date_limit,
@@ -203,13 +205,14 @@ def main(cfg: DictConfig) -> None:
         logger.info(f"Uploading raw chats to S3 bucket {cfg.output.s3_bucket}...")
 
         try:
-            s3.put_object(
+            s3.upload_fileobj(
+                Fileobj=io.BytesIO(
+                    json.dumps(raw_chats, ensure_ascii=False, indent=2).encode("utf-8")
+                ),
                 Bucket=cfg.output.s3_bucket,
                 Key=f"{run_id}/data/raw.json",
-                Body=json.dumps(raw_chats, ensure_ascii=False, indent=2),
-                Metadata={
-                    "uuid": run_id,
-                },
+                ExtraArgs={"Metadata": {"uuid": run_id}},
+                Config=S3_TRANSFER_CONFIG,
             )
             logger.info(
                 f"Successfully uploaded raw chats to s3://{cfg.output.s3_bucket}/{run_id}/raw.json"
@@ -656,11 +659,16 @@ def main(cfg: DictConfig) -> None:
     if "s3" in cfg.output.modes and s3 is not None:
         logger.info(f"Uploading processed chats to S3 bucket {cfg.output.s3_bucket}...")
         try:
-            s3.put_object(
+            s3.upload_fileobj(
+                Fileobj=io.BytesIO(
+                    json.dumps(chat_records, ensure_ascii=False, indent=2).encode(
+                        "utf-8"
+                    )
+                ),
                 Bucket=cfg.output.s3_bucket,
                 Key=f"{run_id}/data/processed.json",
-                Body=json.dumps(chat_records, ensure_ascii=False, indent=2),
-                Metadata=metadata_dict,
+                ExtraArgs={"Metadata": metadata_dict},
+                Config=S3_TRANSFER_CONFIG,
             )
             logger.info(
                 f"Successfully uploaded chats.json to s3://{cfg.output.s3_bucket}/{run_id}/data/processed.json"
@@ -691,11 +699,12 @@ def main(cfg: DictConfig) -> None:
     if "s3" in cfg.output.modes and s3 is not None:
         logger.info(f"Uploading training blocks to S3 bucket {cfg.output.s3_bucket}...")
         try:
-            s3.put_object(
+            s3.upload_fileobj(
+                Fileobj=io.BytesIO("\n".join(training_block_lines).encode("utf-8")),
                 Bucket=cfg.output.s3_bucket,
                 Key=f"{run_id}/data/train.jsonl",
-                Body="\n".join(training_block_lines),
-                Metadata=metadata_dict,
+                ExtraArgs={"Metadata": metadata_dict},
+                Config=S3_TRANSFER_CONFIG,
             )
             logger.info(
                 f"Successfully uploaded train.jsonl to s3://{cfg.output.s3_bucket}/{run_id}/data/train.jsonl"
@@ -40,9 +40,12 @@ class Block(BaseModel):
             Ordered messages in this block. Must begin with 'system' (optional),
             then 'user', and alternate between 'assistant' and 'user',
             ending with 'assistant'.
+        token_count (Optional[int]):
+            Total number of tokens across all messages, if already counted.
     """
 
     messages: List[Message]
+    token_count: Optional[int] = None
 
     @model_validator(
         mode="after"
@@ -90,7 +93,9 @@ class Chat(BaseModel):
         messages: A flat list of all processed messages in chronological order.
         raw_blocks: A list of message blocks. Each block is a list of temporally
                 and contextually related messages, chunked according to time
-                and token limits. Defaults to an empty list.
+                and token limits. Defaults to an empty list. Only populated by the
+                standalone `main.py` script; the API worker (`jobs.tasks.process_chat`)
+                keeps its raw blocks local and leaves this empty.
         valid_blocks: A list of validated Block models. This is populated after chunking, merging,
                     and validating the blocks. Defaults to an empty list.
     """
@@ -100,5 +105,5 @@ class Chat(BaseModel):
         "personal_chat", "private_group", "private_supergroup", "public_supergroup"
     ]
     messages: List[Message]
-    raw_blocks: List[List[Message]] = []  # unmerged, unvalidated message lists
+    raw_blocks: List[List[Message]] = []  # unmerged, unvalidated; main.py only
     valid_blocks: List[Block] = []  # validated Block models
@@ -1,27 +1,297 @@
 # app/jobs/tasks.py
 from __future__ import annotations
 
-import json
+import copy
 import logging
 import os
-from datetime import datetime
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
 
 import boto3
 import hydra
+import numpy as np
+import orjson
 import requests
+import simdjson
+from omegaconf import DictConfig
 from pydantic import ValidationError
 
 from .models import Block, Chat, Message
 from .utils import (
+    S3_TRANSFER_CONFIG,
     calculate_chat_stats,
+    count_tokens_batch,
+    find_block_breaks,
     load_tokenizer,
     parse_date_limit,
+    parse_timestamps,
 )
 
 logger = logging.getLogger(__name__)
 
+# Maps line breaks to spaces in one C-level pass over each message
+_NORMALIZE_TABLE = str.maketrans({"\n": " ", "\r": " "})
+
+
+def _open_payload_file(filepath: Optional[Path] = None) -> BinaryIO:
+    """Opens a read/write binary stream to serialize an export payload into.
+
+    Args:
+        filepath (Optional[Path]): Local file to save the payload to. If None, the
+            payload is spooled to a temporary file (kept in memory up to 32 MB).
+
+    Returns:
+        BinaryIO: An open, empty binary stream.
+    """
+    if filepath is not None:
+        return filepath.open("w+b")
+
+    return tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024)
+
+
+def _spool_payload(payload: bytes, filepath: Optional[Path] = None) -> BinaryIO:
+    """Writes a serialized payload out and returns it as a readable binary stream.
+
+    The stream can be handed to `upload_fileobj` so boto3 reads it in chunks rather
+    than holding a second, re-encoded copy of the payload in memory.
+
+    Args:
+        payload (bytes): The serialized payload.
+        filepath (Optional[Path]): Local file to save the payload to. If None, the
+            payload is spooled to a temporary file (kept in memory up to 32 MB).
+
+    Returns:
+        BinaryIO: An open binary stream positioned at the start of the payload.
+    """
+    payload_file = _open_payload_file(filepath)
+    payload_file.write(payload)
+    payload_file.seek(0)
+    return payload_file
+
+
+def _upload_payload(
+    s3_client: boto3.client,
+    payload_file: BinaryIO,
+    bucket: str,
+    key: str,
+    metadata: Dict[str, str],
+) -> None:
+    """Uploads a payload stream to S3, closing the stream once done.
+
+    Args:
+        s3_client (boto3.client): Authenticated Boto3 S3 client.
+        payload_file (BinaryIO): Readable binary stream, e.g. from `_spool_payload`.
+        bucket (str): Name of the S3 bucket.
+        key (str): Object key to upload to.
+        metadata (Dict[str, str]): S3 object metadata.
+    """
+    with payload_file:
+        s3_client.upload_fileobj(
+            payload_file,
+            bucket,
+            key,
+            ExtraArgs={"Metadata": metadata},
+            Config=S3_TRANSFER_CONFIG,
+        )
+    logger.info(f"Successfully uploaded s3://{bucket}/{key}")
+
+
+_CFG_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _load_cfg() -> DictConfig:
+    """Composes the Hydra configuration once per process.
+
+    Returns:
+        DictConfig: The composed base configuration. Must not be mutated.
+    """
+    with hydra.initialize(config_path="../../../conf"):
+        return hydra.compose(config_name="config")
+
+
+def _get_cfg() -> DictConfig:
+    """Returns a private copy of the cached Hydra configuration for a single job.
+
+    Overrides are applied to the copy, so jobs never see each other's overrides.
+
+    Returns:
+        DictConfig: A deep copy of the composed configuration.
+    """
+    with _CFG_LOCK:  # Hydra's global state is not safe to initialise from two threads
+        return copy.deepcopy(_load_cfg())
+
+
+def process_chat(
+    chat: Chat,
+    timestamps: np.ndarray,
+    token_counts: List[int],
+    count_tokens: Callable[[str], int],
+    convo_thereshold_secs: float,
+    min_tokens: int,
+    max_tokens: int,
+    delimiter_prefix: str,
+    system_message: Optional[Message] = None,
+) -> Dict[str, int]:
+    """Chunks, merges and role-checks the messages of one chat into training blocks.
+
+    Runs steps 5, 6 and 6b of `run_data_processing` for a single chat, keeping the
+    intermediate blocks local while its messages are still hot in cache. Only
+    `chat.valid_blocks` is written.
+
+    Args:
+        chat (Chat): Chat with chronologically sorted messages.
+        timestamps (np.ndarray): datetime64 timestamps of `chat.messages`.
+        token_counts (List[int]): Token count of each of `chat.messages`.
+        count_tokens (Callable[[str], int]): Token counter for merged contents.
+        convo_thereshold_secs (float): Maximum gap (in seconds) between messages in a block.
+        min_tokens (int): Minimum number of tokens per block.
+        max_tokens (int): Maximum number of tokens per block.
+        delimiter_prefix (str): Prefix for every line of a merged message (e.g. ">>> ").
+        system_message (Optional[Message]): System message to prepend to every block.
+
+    Returns:
+        Dict[str, int]: Block counts for logging: "num_chunks" blocks kept by chunking,
+            "short_chunks" / "long_chunks" discarded by chunking, and "short_blocks" /
+            "long_blocks" discarded by the role-sanity pass.
+    """
+    counts = {
+        "num_chunks": 0,
+        "short_chunks": 0,
+        "long_chunks": 0,
+        "short_blocks": 0,
+        "long_blocks": 0,
+    }
+
+    # -------------------------------
+    # 5) Chunking the chat into conversation 'blocks'
+    # -------------------------------
+    # Split Chat.messages into “blocks” so that each block:
+    #   • Maintains temporal context (messages no more than time_threshold_sec apart)
+    #   • Stays within a token-budget (min_tokens ≤ block_tokens ≤ max_tokens)
+    # Block boundaries: a time gap above the threshold, or a token budget overflow
+    breaks = find_block_breaks(
+        timestamps,
+        token_counts,
+        convo_thereshold_secs,
+        max_tokens,
+    )
+    starts = np.flatnonzero(breaks)
+    ends = np.append(starts[1:], len(chat.messages))
+    block_tokens = np.add.reduceat(np.asarray(token_counts), starts)
+
+    # Keep only blocks within the token budget
+    raw_blocks: List[List[Message]] = []
+    for start, end, tokens in zip(
+        starts.tolist(), ends.tolist(), block_tokens.tolist()
+    ):
+        if min_tokens <= tokens <= max_tokens:
+            raw_blocks.append(chat.messages[start:end])
+        elif tokens < min_tokens:
+            counts["short_chunks"] += 1
+        else:
+            counts["long_chunks"] += 1
+    counts["num_chunks"] = len(raw_blocks)
+
+    valid_blocks: List[Block] = []
+    min_msgs = 3 if system_message else 2
+    # The system message is shared by every block, so count its tokens once
+    system_tokens = count_tokens(system_message.content) if system_message else 0
+
+    for raw_block in raw_blocks:
+        # -------------------------------
+        # 6) Merge consecutive messages by sender within the block
+        # -------------------------------
+        #   • Group consecutive messages from the same sender into one Message
+        #   • Prefix every line with the delimiter (e.g. '>>>')
+        #   • Separate lines with '\n'
+        #   • Keep the timestamp of the first message in each group
+        block: List[Message] = []
+
+        first_msg = raw_block[0]
+        current_sender = first_msg.role
+        current_timestamp = first_msg.timestamp
+        # Collect the lines of each merged message and join them once,
+        # rather than growing a string with += (quadratic in the run length)
+        current_lines = [delimiter_prefix + first_msg.content]
+
+        for msg in raw_block[1:]:
+            if msg.role == current_sender:  # concatenate messages from the same sender
+                current_lines.append(delimiter_prefix + msg.content)
+            else:
+                # Create and add the merged message to the list. Its parts were
+                # validated in step 4, so skip re-validation.
+                block.append(
+                    Message.model_construct(
+                        role=current_sender,
+                        content="\n".join(current_lines),
+                        timestamp=current_timestamp,
+                    )
+                )
+
+                current_sender = msg.role
+                current_timestamp = msg.timestamp
+                current_lines = [delimiter_prefix + msg.content]
+
+        # Add last merged message
+        block.append(
+            Message.model_construct(
+                role=current_sender,
+                content="\n".join(current_lines),
+                timestamp=current_timestamp,
+            )
+        )
+
+        # ------------------------------------------------------------------
+        # 6b) Ensure the block starts with SYSTEM (if specified), USER and ends with ASSISTANT
+        # ------------------------------------------------------------------
+        # Trim leading assistant messages
+        i = 0
+        while i < len(block) and block[i].role == "assistant":
+            i += 1
+
+        # Trim trailing user messages
+        j = len(block)
+        while j > i and block[j - 1].role == "user":
+            j -= 1
+
+        # structural length check, before any tokens are counted or lists built
+        if (j - i) + (1 if system_message else 0) < min_msgs:
+            counts["short_blocks"] += 1
+            continue
+
+        # token‐count check
+        token_count = system_tokens + sum(
+            count_tokens(block[k].content) for k in range(i, j)
+        )
+        if token_count < min_tokens:
+            counts["short_blocks"] += 1
+            continue
+        elif token_count > max_tokens:
+            counts["long_blocks"] += 1
+            continue
+
+        # Slice once (and add a system message if specified) instead of
+        # popping/inserting at the head, which shifts the whole list each time
+        if system_message:
+            block = [system_message] + block[i:j]
+        else:
+            block = block[i:j]
+
+        # Create a new Block object with the trimmed messages. Merged roles
+        # alternate and the trimming above guarantees a user start and an
+        # assistant end, so the structure validator cannot fail here.
+        valid_blocks.append(
+            Block.model_construct(messages=block, token_count=token_count)
+        )
+
+    chat.valid_blocks = valid_blocks
+    return counts
+
 
 def run_data_processing(
     run_id: str,
@@ -52,9 +322,8 @@ def run_data_processing(
         FileNotFoundError: If the raw JSON file cannot be found.
         RuntimeError: For any S3 upload/download or processing errors.
     """
-    # Load configuration
-    with hydra.initialize(config_path="../../../conf"):
-        cfg = hydra.compose(config_name="config")
+    # Load configuration (composed once per process, copied per job)
+    cfg = _get_cfg()
 
     # Apply overrides
     logger.info(f"Applying configuration overrides: {overrides}")
@@ -71,27 +340,27 @@ def run_data_processing(
     logger.info(f"cfg.fine_tuning.model: {cfg.fine_tuning.model}")
     logger.info(f"cfg.fine_tuning.training: {cfg.fine_tuning.training}")
     logger.info(f"cfg: {cfg}")
+
+    # Map every config key to the first section that defines it (main config first),
+    # so each override is routed with a single dict lookup.
+    routes: Dict[str, Tuple[str, DictConfig]] = {}
+    for section, section_cfg in (
+        ("main", cfg),
+        ("dataset", cfg.fine_tuning.dataset),
+        ("lora", cfg.fine_tuning.lora),
+        ("model", cfg.fine_tuning.model),
+        ("training", cfg.fine_tuning.training),
+    ):
+        for config_key in section_cfg:
+            routes.setdefault(config_key, (section, section_cfg))
+
     for key, value in overrides.items():
-        if hasattr(cfg, key):  # Check if the attribute exists in cfg
-            logger.debug(f"Applying main config override: {key}={value}")
-            setattr(cfg, key, value)
-            override_counts["main"] += 1
-        elif hasattr(cfg.fine_tuning.dataset, key):
-            logger.debug(f"Applying dataset override: {key}={value}")
-            setattr(cfg.fine_tuning.dataset, key, value)
-            override_counts["dataset"] += 1
-        elif hasattr(cfg.fine_tuning.lora, key):
-            logger.debug(f"Applying LoRA override: {key}={value}")
-            setattr(cfg.fine_tuning.lora, key, value)
-            override_counts["lora"] += 1
-        elif hasattr(cfg.fine_tuning.model, key):
-            logger.debug(f"Applying model override: {key}={value}")
-            setattr(cfg.fine_tuning.model, key, value)
-            override_counts["model"] += 1
-        elif hasattr(cfg.fine_tuning.training, key):
-            logger.debug(f"Applying training override: {key}={value}")
-            setattr(cfg.fine_tuning.training, key, value)
-            override_counts["training"] += 1
+        route = routes.get(key)
+        if route is not None:
+            section, section_cfg = route
+            logger.debug(f"Applying {section} config override: {key}={value}")
+            setattr(section_cfg, key, value)
+            override_counts[section] += 1
         else:
             logger.warning(f"Override skipped: '{key}' not found in configuration.")
             override_counts["skipped"] += 1
@@ -102,25 +371,134 @@ def run_data_processing(
         f"Training: {override_counts['training']}, Skipped: {override_counts['skipped']}"
     )
 
+    # Steps 1-8 share one pool: the tokenizer loads in the background while the raw
+    # chats are loaded, and the S3 uploads run alongside the remaining steps.
+    executor = ThreadPoolExecutor(max_workers=4)
+    try:
+        chat_stats = _prepare_training_data(
+            run_id, raw_json_path, s3_client, cfg, executor
+        )
+    finally:
+        # Runs on failure too: workers exit once their current task is done and
+        # anything still queued is cancelled
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # -------------------------------
+    # 9) Send request to fine-tuning service to start the training job
+    # -------------------------------
+    fine_tuning_url = os.getenv("FINE_TUNING_SERVICE_URL")
+
+    if not fine_tuning_url:
+        logger.error("FINE_TUNING_SERVICE_URL environment variable is not set.")
+        return chat_stats
+
+    # Send request to start fine-tuning
+    try:
+        response = requests.post(
+            fine_tuning_url,
+            json={"run_id": run_id},
+            headers={"Content-Type": "application/json"},
+        )
+
+        if response.status_code == 200:
+            logger.info(f"Successfully queued fine-tuning job: {response.json()}")
+        else:
+            logger.error(
+                f"Failed to queue fine-tuning job: {response.status_code} - {response.text}"
+            )
+
+    except Exception as e:
+        logger.error(f"Error sending fine-tuning request: {e}")
+
+    return chat_stats
+
+
+def _prepare_training_data(
+    run_id: str,
+    raw_json_path: str,
+    s3_client: boto3.client,
+    cfg: DictConfig,
+    executor: ThreadPoolExecutor,
+) -> Dict[str, Any]:
+    """Loads, processes and exports the chats (steps 1-8 of `run_data_processing`).
+
+    Args:
+        run_id (str): UUID string identifying this job.
+        raw_json_path (str): Path to the temporary JSON file containing raw chat data.
+        s3_client (boto3.client): Authenticated Boto3 S3 client.
+        cfg (DictConfig): Job configuration, with overrides applied.
+        executor (ThreadPoolExecutor): Pool for the tokenizer load and the S3 uploads.
+            The caller owns it and shuts it down.
+
+    Returns:
+        Dict[str, Any]: Summary statistics of the processed chats.
+    """
+    # Resolve the settings used below into plain Python values once, instead of
+    # going through OmegaConf attribute lookup (interpolation + validation) on every access
+    model_name: str = str(cfg.fine_tuning.model.name)
+    # Name identifying "our" side of the conversation, renamed to "assistant" in the output
+    target_name: str = str(cfg.target_name)
+    date_limit = parse_date_limit(
+        cfg.date_limit  # Optional date limit for filtering messages
+    )
+    convo_thereshold_secs = float(cfg.convo_block_thereshold_secs)
+    min_tokens = int(cfg.min_tokens_per_block)
+    max_tokens = int(cfg.max_tokens_per_block)
+    delimiter: str = str(cfg.message_delimiter).strip()
+    # Contents are already stripped in step 4; with an empty delimiter no prefix
+    # is added, so merged contents stay stripped without re-validation.
+    delimiter_prefix: str = f"{delimiter} " if delimiter else ""
+    system_prompt_text: Optional[str] = (
+        str(cfg.system_prompt) if cfg.system_prompt else None
+    )
+    local_dir = Path(cfg.output.local_dir)
+    save_local: bool = "local" in cfg.output.modes
+    s3_bucket: str = str(cfg.output.s3_bucket)
+
+    # Loading the tokenizer (network fetch or disk read) does not depend on the
+    # chats, so start it now and overlap it with steps 1 and 2. The same pool
+    # runs the S3 uploads in steps 2 and 8.
+    logger.info(f"Loading tokenizer for model {model_name} for token counting...")
+    tokenizer_future = executor.submit(load_tokenizer, model_name=model_name)
+
     # --------------------------------------------------------------------
     # 1) Load raw chats from temp file, then delete the file when done
     # --------------------------------------------------------------------
     path = Path(raw_json_path)
     raw_chats: List[Dict] = []
     try:
-        data = json.loads(path.read_text(encoding="utf-8"))
+        # simdjson parses into lazy proxies backed by the parser's buffer, so only
+        # the chat objects we select are converted to Python (a full Telegram export
+        # also carries contacts, profile info, etc. that we never read).
+        # Keep `parser` alive until every proxy has been materialised.
+        parser = simdjson.Parser()
+        data = parser.parse(path.read_bytes())
 
-        if isinstance(data, list):
-            raw_chats = [c for c in data if {"name", "messages"} <= c.keys()]
+        try:
+            # Full Telegram export (result.json): {"chats": {"list": [...]}}
+            raw_chats = data["chats"]["list"].as_list()
+
+        except (KeyError, TypeError):
+            if isinstance(data, simdjson.Array):
+                raw_chats = [
+                    c.as_dict()
+                    for c in data
+                    if isinstance(c, simdjson.Object)
+                    and "name" in c
+                    and "messages" in c
+                ]
 
-        elif isinstance(data, dict) and "chats" in data and "list" in data["chats"]:
-            raw_chats = data["chats"]["list"]
+            elif (
+                isinstance(data, simdjson.Object)
+                and "name" in data
+                and "messages" in data
+            ):
+                raw_chats = [data.as_dict()]
 
-        elif isinstance(data, dict) and {"name", "messages"} <= data.keys():
-            raw_chats = [data]
+            else:
+                raise ValueError("Unrecognised JSON structure")
 
-        else:
-            raise ValueError("Unrecognised JSON structure")
+        del data
 
         if not raw_chats:
             raise ValueError("List contained no valid chat objects")
@@ -138,37 +516,31 @@ def run_data_processing(
     # 2) Export: Raw Chats - local / s3
     # -------------------------------
     # Define base paths
-    base_dir = Path(cfg.output.local_dir)
-    run_dir = base_dir / run_id
+    run_dir = local_dir / run_id
 
     # Save locally if configured
-    if "local" in cfg.output.modes:
+    raw_chats_filepath = None
+    if save_local:
         logger.info(f"Saving raw chats locally to {run_dir}...")
 
         run_dir.mkdir(parents=True, exist_ok=True)
         raw_chats_filepath = run_dir / "raw.json"
 
-        with raw_chats_filepath.open("w", encoding="utf-8") as f:
-            json.dump(raw_chats, f, ensure_ascii=False, indent=2)
+    raw_chats_file = _spool_payload(
+        orjson.dumps(raw_chats, option=orjson.OPT_INDENT_2), raw_chats_filepath
+    )
 
-    # Upload to S3
-    logger.info(f"Uploading raw chats to S3 bucket {cfg.output.s3_bucket}...")
+    # Upload to S3 in the background, overlapping with the tokenizer download
+    logger.info(f"Uploading raw chats to S3 bucket {s3_bucket}...")
 
-    try:
-        s3_client.put_object(
-            Bucket=cfg.output.s3_bucket,
-            Key=f"{run_id}/data/raw.json",
-            Body=json.dumps(raw_chats, ensure_ascii=False, indent=2),
-            Metadata={
-                "uuid": run_id,
-            },
-        )
-        logger.info(
-            f"Successfully uploaded raw chats to s3://{cfg.output.s3_bucket}/{run_id}/raw.json"
-        )
-    except Exception as e:
-        logger.error(f"Failed to upload raw chats to S3: {e}")
-        raise
+    raw_upload = executor.submit(
+        _upload_payload,
+        s3_client,
+        raw_chats_file,
+        s3_bucket,
+        f"{run_id}/data/raw.json",
+        {"uuid": run_id},
+    )
 
     # ---------------------
     # 3) Tokenizer loading
@@ -177,10 +549,14 @@ def run_data_processing(
     #  - Prefer the same tokenizer family (e.g. BPE, SentencePiece, WordPiece) as our target finetuning model for accuracy.
     #  - Use HuggingFace’s AutoTokenizer to load the specific tokenizer for the target model.
     #  - If that fails, fall back to OpenAI’s tiktoken (BPE) for speed and API‑compatibility.
-    logger.info(
-        f"Loading tokenizer for model {cfg.fine_tuning.model.name} for token counting..."
-    )
-    tokenizer = load_tokenizer(model_name=cfg.fine_tuning.model.name)
+    # The load was started in the background before step 1; wait for it here.
+    tokenizer = tokenizer_future.result()
+
+    try:
+        raw_upload.result()
+    except Exception as e:
+        logger.error(f"Failed to upload raw chats to S3: {e}")
+        raise
 
     # --------------------------------------------
     # 4) Build Chat objects
@@ -201,10 +577,8 @@ def run_data_processing(
     logger.info("Building chat objects from raw chats...")
 
     chats: List[Chat] = []
-    target_name = cfg.target_name  # Name identifying "our" side of the conversation, renamed to "assistant" in the output
-    date_limit = parse_date_limit(
-        cfg.date_limit  # Optional date limit for filtering messages
-    )
+    # datetime64 timestamps, aligned with chats
+    chat_timestamps: List[np.ndarray] = []
 
     for chat in raw_chats:
         contact_name = chat.get("name")
@@ -219,7 +593,11 @@ def run_data_processing(
         if chat_type not in ["personal_chat"]:
             continue
 
-        msgs: List[Message] = []
+        # Collect dates, senders and texts as parallel arrays (structure-of-arrays),
+        # so date parsing, date filtering and role assignment can run vectorised.
+        raw_dates: List[str] = []
+        raw_senders: List[str] = []
+        raw_texts: List[str] = []
         for msg in chat.get("messages", []):
             try:
                 sender = msg.get("from", "")
@@ -232,37 +610,61 @@ def run_data_processing(
                     continue
 
                 # Reconstruct the textual content from entities + emoji.
-                raw_text = "".join(ent["text"] for ent in ents) + sticker
-                # Remove leading/trailing whitespace and replace internal newlines with spaces.
+                raw_text = "".join([ent["text"] for ent in ents]) + sticker
+                # Replace line breaks with spaces and remove leading/trailing whitespace.
                 # Newlines will be used later to delimit merged messages.
-                content = raw_text.strip().replace("\n", " ")
-
-                # Parse timestamp and apply date filter if set.
-                timestamp = datetime.fromisoformat(msg["date"])
-                if date_limit and timestamp < date_limit:
+                content = raw_text.translate(_NORMALIZE_TABLE).strip()
+                if not content:  # whitespace-only, skip before any date handling
                     continue
+                date = msg["date"]
+
+            except Exception as e:
+                logger.warning(
+                    f"[{contact_name}] skipping a message due to parse error: {e}"
+                )
+                continue
+
+            raw_dates.append(date)
+            raw_senders.append(sender)
+            raw_texts.append(content)
 
+        if not raw_texts:
+            continue
+
+        # Parse timestamps and apply date filter if set.
+        dates = parse_timestamps(raw_dates, contact_name)
+        keep_mask = ~np.isnat(dates)
+        if date_limit:
+            keep_mask &= dates >= np.datetime64(date_limit)
+
+        # Assign role based on sender
+        roles = np.where(
+            np.array(raw_senders, dtype=object) == target_name, "assistant", "user"
+        ).tolist()
+
+        # Kept messages in chronological order (stable, like list.sort)
+        kept = np.flatnonzero(keep_mask)
+        kept = kept[np.argsort(dates[kept], kind="stable")]
+
+        msgs: List[Message] = []
+        msg_indices: List[int] = []
+        for idx, timestamp in zip(kept.tolist(), dates[kept].tolist()):
+            try:
                 msgs.append(
                     Message(
-                        role="assistant"  # Assign role based on sender
-                        if sender == target_name
-                        else "user",  # Assign sender role based on target_name
-                        content=content,
+                        role=roles[idx],
+                        content=raw_texts[idx],
                         timestamp=timestamp,
                     )
                 )
-
-            except Exception as e:
+                msg_indices.append(idx)
+            except ValidationError as e:
                 logger.warning(
                     f"[{contact_name}] skipping a message due to parse error: {e}"
                 )
 
         # If we found any valid messages, construct and append the Conversation object.
         if msgs:
-            msgs.sort(
-                key=lambda m: m.timestamp
-            )  # Sort messages by timestamp to ensure chronological order.
-
             try:
                 # Create a new Chat object with the parsed messages
                 chat = Chat(
@@ -271,6 +673,9 @@ def run_data_processing(
                     messages=msgs,
                 )
                 chats.append(chat)
+                # Keep the parsed dates for chunking, rather than converting the
+                # Message datetimes back to NumPy later
+                chat_timestamps.append(dates[msg_indices])
             except ValidationError as e:
                 logger.warning(
                     f"Failed to create chat object for '{contact_name}': {e}"
@@ -280,17 +685,14 @@ def run_data_processing(
     logger.info(f"Built {len(chats)} usable chat objects.")
 
     # -------------------------------
-    # 5) Chunking each chat into conversation 'blocks'
+    # 5) - 6b) Chunk, merge and role-check each chat into training blocks
     # -------------------------------
-    # Split each Chat.messages into “blocks” so that each block:
-    #   • Maintains temporal context (messages no more than time_threshold_sec apart)
-    #   • Stays within a token-budget (min_tokens ≤ block_tokens ≤ max_tokens)
+    # Each chat goes through the whole pipeline in one pass (see `process_chat`):
+    #   5) Chunk messages into blocks by time gap and token budget
+    #   6) Merge consecutive messages by sender within each block
+    #   6b) Trim each block to start with USER and end with ASSISTANT, prepend SYSTEM (if specified)
     # This ensures that during LLM training each example has coherent context, and is neither too short (unhelpful) nor too long (slow to train on).
 
-    convo_thereshold_secs = cfg.convo_block_thereshold_secs
-    min_tokens = cfg.min_tokens_per_block
-    max_tokens = cfg.max_tokens_per_block
-
     # Sanity‑checks
     if min_tokens >= max_tokens:
         logger.warning(
@@ -299,157 +701,16 @@ def run_data_processing(
         )
         min_tokens, max_tokens = 100, 3000
 
-    # variables to track block counts
-    num_short_blocks = 0
-    num_long_blocks = 0
-
-    logger.info("Chunking chats into blocks...")
-    for chat in chats:
-        current_block: List[Message] = []
-        current_tokens = 0
-        previous_time: Optional[datetime] = None
-
-        for msg in chat.messages:
-            gap = (
-                (msg.timestamp - previous_time).total_seconds()
-                if previous_time
-                else None
-            )
-            msg_tokens = len(tokenizer.encode(msg.content))
-
-            # Continue block if within time and token limits
-            if (
-                previous_time
-                and gap <= convo_thereshold_secs
-                and (current_tokens + msg_tokens) <= max_tokens
-            ):
-                current_block.append(msg)
-                current_tokens += msg_tokens
-            else:
-                # Commit the existing block
-                if current_block:
-                    if min_tokens <= current_tokens <= max_tokens:
-                        chat.raw_blocks.append(current_block)
-                    elif current_tokens < min_tokens:
-                        num_short_blocks += 1
-                    else:
-                        num_long_blocks += 1
-
-                # Start a new block
-                current_block = [msg]
-                current_tokens = msg_tokens
-
-            previous_time = msg.timestamp
-
-        # Commit any remaining block
-        if current_block:
-            if min_tokens <= current_tokens <= max_tokens:
-                chat.raw_blocks.append(current_block)
-            elif current_tokens < min_tokens:
-                num_short_blocks += 1
-            else:
-                num_long_blocks += 1
-
-    # Discard empty chats with empty blocks
-    num_original_chats = len(chats)
-    chats = [c for c in chats if c.raw_blocks]
-    num_discarded_chats = num_original_chats - len(chats)
-
-    # Log the results
-    num_total_blocks = sum(len(c.raw_blocks) for c in chats)
-    logger.info(
-        f"Chunking complete: {num_original_chats} conversations → {len(chats)} conversations ({num_discarded_chats} discarded due to empty blocks), "
-        f"{num_total_blocks} chat blocks created; discarded short {num_short_blocks} blocks and {num_long_blocks} long blocks."
-    )
-
-    # -------------------------------
-    # 6) Merge consecutive messages by sender within each block
-    # -------------------------------
-    # For each block in each Conversation, we:
-    #   • Group consecutive messages from the same sender into one Message
-    #   • Prefix every line with the delimiter (e.g. '>>>')
-    #   • Separate lines with '\n'
-    #   • Keep the timestamp of the first message in each group
-    #   • For each block, trim leading assistant messages and trailing user messages
-    #   • Add a system message at the start of each block if specified
-    logger.info("Merging consecutive messages by sender within each block...")
-    delimiter = cfg.message_delimiter.strip()
-
-    for chat in chats:
-        merged_blocks: List[List[Message]] = []
-
-        for block in chat.raw_blocks:
-            current_block: List[Message] = []
-
-            first_msg = block[0]
-            current_sender = first_msg.role
-            current_timestamp = first_msg.timestamp
-            current_content = f"{delimiter} {first_msg.content.strip()}"
-
-            for msg in block[1:]:
-                if (
-                    msg.role == current_sender
-                ):  # concatenate messages from the same sender
-                    current_content += f"\n{delimiter} {msg.content.strip()}"
-                else:
-                    try:
-                        # Create and add the merged message to the list
-                        current_block.append(
-                            Message(
-                                role=current_sender,
-                                content=current_content,
-                                timestamp=current_timestamp,
-                            )
-                        )
-                    except ValidationError as e:
-                        logger.warning(
-                            f"Failed to create merged message for chat '{chat.contact_name}', "
-                            f"block starting at {block[0].timestamp if block else 'unknown'}: {e}"
-                        )
-                        continue
-
-                    current_sender = msg.role
-                    current_timestamp = msg.timestamp
-                    current_content = f"{delimiter} {msg.content.strip()}"
-
-            # Add last merged message if exists
-            if current_content:
-                try:
-                    # Create and add the merged message to the list
-                    current_block.append(
-                        Message(
-                            role=current_sender,
-                            content=current_content,
-                            timestamp=current_timestamp,
-                        )
-                    )
-                except ValidationError as e:
-                    logger.warning(
-                        f"Failed to create merged message for chat '{chat.contact_name}', "
-                        f"block starting at {block[0].timestamp if block else 'unknown'}: {e}"
-                    )
-                    continue
-
-            merged_blocks.append(current_block)
-
-        chat.raw_blocks = merged_blocks
-
-    # ------------------------------------------------------------------
-    # 6b) Ensure each block starts with SYSTEM (if specified), USER and ends with ASSISTANT
-    # ------------------------------------------------------------------
-    discarded_short_blocks = 0
-    discarded_long_blocks = 0
     system_message = None
-
-    if cfg.system_prompt:
+    if system_prompt_text:
         logger.info(
-            f"Prepending system message to each conversation block with content: {cfg.system_prompt}"
+            f"Prepending system message to each conversation block with content: {system_prompt_text}"
         )
         # Try to build the system message first
         try:
             system_message = Message(
                 role="system",
-                content=cfg.system_prompt,
+                content=system_prompt_text,
                 timestamp=None,
             )
         except Exception as e:
@@ -457,56 +718,61 @@ def run_data_processing(
                 f"Failed to create system message, skipping system prompts: {e}"
             )
 
-    for chat in chats:
-        valid_blocks: List[Block] = []
-
-        for block in chat.raw_blocks:
-            if not block:
-                continue
-
-            # Trim leading assistant messages
-            while block and block[0].role == "assistant":
-                block.pop(0)
-
-            # Trim trailing user messages
-            while block and block[-1].role == "user":
-                block.pop()
+    # Merged contents repeat often ("ok", stickers, short replies across chats),
+    # so memoise token counts per unique string instead of re-encoding each one.
+    @lru_cache(maxsize=None)
+    def count_tokens(text: str) -> int:
+        return len(tokenizer.encode(text))
+
+    logger.info("Chunking, merging and role-checking chats into blocks...")
+    block_counts = {
+        "num_chunks": 0,
+        "short_chunks": 0,
+        "long_chunks": 0,
+        "short_blocks": 0,
+        "long_blocks": 0,
+    }
+    num_original_chats = len(chats)
+    processed_chats: List[Chat] = []
 
-            # Add a system message if specified
-            if system_message:
-                block.insert(0, system_message)
+    for chat, timestamps in zip(chats, chat_timestamps):
+        # Tokenize the chat's messages in batched calls, one chat at a time so the
+        # token ids of the whole export are never held in memory together
+        token_counts = count_tokens_batch(
+            tokenizer, [msg.content for msg in chat.messages]
+        )
 
-            # structural length check
-            min_msgs = 3 if system_message else 2
-            if len(block) < min_msgs:
-                discarded_short_blocks += 1
-                continue
+        chat_block_counts = process_chat(
+            chat,
+            timestamps,
+            token_counts,
+            count_tokens,
+            convo_thereshold_secs,
+            min_tokens,
+            max_tokens,
+            delimiter_prefix,
+            system_message,
+        )
+        for key, count in chat_block_counts.items():
+            block_counts[key] += count
 
-            # token‐count check
-            token_count = sum(len(tokenizer.encode(m.content)) for m in block)
-            if token_count < min_tokens:
-                discarded_short_blocks += 1
-                continue
-            elif token_count > max_tokens:
-                discarded_long_blocks += 1
-                continue
-            discarded_blocks = discarded_short_blocks + discarded_long_blocks
+        # Discard chats where chunking produced no blocks
+        if chat_block_counts["num_chunks"]:
+            processed_chats.append(chat)
 
-            try:
-                # Create a new Block object with the trimmed messages
-                block = Block(messages=block)
-                valid_blocks.append(block)
+    chats = processed_chats
+    count_tokens.cache_clear()  # release the memoised strings
 
-            except ValidationError as e:
-                logger.warning(
-                    f"Failed to create block for chat '{chat.contact_name}', "
-                    f"block starting at {block.messages[0].timestamp if block else 'unknown'}: {e}"
-                )
-                discarded_blocks += 1
-                continue
-
-        chat.valid_blocks = valid_blocks
+    # Log the results
+    num_discarded_chats = num_original_chats - len(chats)
+    logger.info(
+        f"Chunking complete: {num_original_chats} conversations → {len(chats)} conversations ({num_discarded_chats} discarded due to empty blocks), "
+        f"{block_counts['num_chunks']} chat blocks created; discarded short {block_counts['short_chunks']} blocks and {block_counts['long_chunks']} long blocks."
+    )
 
+    discarded_short_blocks = block_counts["short_blocks"]
+    discarded_long_blocks = block_counts["long_blocks"]
+    discarded_blocks = discarded_short_blocks + discarded_long_blocks
     logger.info(
         f"Role‑sanity pass complete: {sum(len(chat.valid_blocks) for chat in chats)} valid blocks kept, "
         f"total of {discarded_blocks} blocks discarded, {discarded_short_blocks} short blocks and {discarded_long_blocks} long blocks."
@@ -516,14 +782,16 @@ def run_data_processing(
     # 7) Log summary statistics
     # -------------------------------
     logger.info("Calculating statistics of processed chats...")
-    chat_stats = calculate_chat_stats(chats, tokenizer)
+    chat_stats = calculate_chat_stats(chats, tokenizer)  # reuses Block.token_count
 
     # Define the number of top entries to display
     k = 10
 
     # Extract and sort the block breakdown by the number of blocks in descending order
     top_k_breakdown = sorted(
-        chat_stats["block_breakdown"].items(), key=lambda item: item[1], reverse=True
+        chat_stats["block_breakdown"].items(),
+        key=lambda item: item[1],
+        reverse=True,
     )[:k]
 
     stats_table = "\n"
@@ -568,8 +836,8 @@ def run_data_processing(
     # --- Manually Define Metadata ---
     metadata_dict = {
         "uuid": run_id,
-        "model_id": cfg.fine_tuning.model.name,
-        "target_name": cfg.target_name,
+        "model_id": model_name,
+        "target_name": target_name,
         "system_prompt": str(cfg.system_prompt) if cfg.system_prompt else "None",
         "date_limit": str(cfg.date_limit) if cfg.date_limit else "None",
         "convo_block_thereshold_secs": str(cfg.convo_block_thereshold_secs),
@@ -583,7 +851,7 @@ def run_data_processing(
 
     fine_tuning_metadata = {
         # Model settings
-        "model_name": cfg.fine_tuning.model.name,
+        "model_name": model_name,
         "max_seq_length": str(cfg.fine_tuning.model.max_seq_length),
         "load_in_4bit": str(cfg.fine_tuning.model.load_in_4bit),
         "chat_template": cfg.fine_tuning.model.chat_template,
@@ -630,9 +898,9 @@ def run_data_processing(
                 {
                     "messages": [
                         {
-                            "timestamp": msg.timestamp.isoformat()
-                            if msg.timestamp
-                            else None,
+                            # orjson encodes datetimes natively (ISO 8601), so no
+                            # intermediate isoformat() string is built per message
+                            "timestamp": msg.timestamp,
                             "role": msg.role,
                             "content": msg.content,
                         }
@@ -645,30 +913,43 @@ def run_data_processing(
         chat_records.append(chat_record)
 
     # 8.2) Save processed chats locally if needed
-    if "local" in cfg.output.modes:
+    if save_local:
         logger.info(f"Saving processed chats locally to {processed_chats_filepath}...")
-        with processed_chats_filepath.open("w", encoding="utf-8") as f:
-            json.dump(chat_records, f, ensure_ascii=False, indent=2)
+    else:
+        processed_chats_filepath = None
+
+    processed_chats_file = _spool_payload(
+        orjson.dumps(chat_records, option=orjson.OPT_INDENT_2),
+        processed_chats_filepath,
+    )
+
+    # 8.3) Upload processed chats to S3 in the background, while the training blocks are prepared
+    uploads: Dict[str, Future] = {}
 
-    # 8.3) Upload processed chats to S3
     if s3_client is not None:
-        logger.info(f"Uploading processed chats to S3 bucket {cfg.output.s3_bucket}...")
-        try:
-            s3_client.put_object(
-                Bucket=cfg.output.s3_bucket,
-                Key=f"{run_id}/data/processed.json",
-                Body=json.dumps(chat_records, ensure_ascii=False, indent=2),
-                Metadata=metadata_dict,
-            )
-            logger.info(
-                f"Successfully uploaded chats.json to s3://{cfg.output.s3_bucket}/{run_id}/data/processed.json"
-            )
-        except Exception as e:
-            logger.error(f"Failed to upload chats.json to S3: {e}")
+        logger.info(f"Uploading processed chats to S3 bucket {s3_bucket}...")
+        uploads["processed.json"] = executor.submit(
+            _upload_payload,
+            s3_client,
+            processed_chats_file,
+            s3_bucket,
+            f"{run_id}/data/processed.json",
+            metadata_dict,
+        )
+    else:
+        processed_chats_file.close()
 
     # 8.4) Save training blocks locally if needed
     logger.info("Preparing training blocks...")
-    training_block_lines = []
+    if save_local:
+        logger.info(f"Saving training blocks locally to {training_blocks_filepath}...")
+    else:
+        training_blocks_filepath = None
+
+    # Write one JSON line per block straight into the output stream, so the
+    # whole dataset is never held in memory as a list of lines plus their join
+    training_blocks_file = _open_payload_file(training_blocks_filepath)
+    separator = b""
     for chat in chats:
         for block in chat.valid_blocks:
             record = {
@@ -676,56 +957,31 @@ def run_data_processing(
                     {"role": msg.role, "content": msg.content} for msg in block.messages
                 ]
             }
-            training_block_lines.append(
-                json.dumps(record, ensure_ascii=False, separators=(",", ":"))
-            )
+            training_blocks_file.write(separator)
+            training_blocks_file.write(orjson.dumps(record))
+            separator = b"\n"
 
-    if "local" in cfg.output.modes:
-        logger.info(f"Saving training blocks locally to {training_blocks_filepath}...")
-        with training_blocks_filepath.open("w", encoding="utf-8") as f:
-            f.write("\n".join(training_block_lines))
+    training_blocks_file.seek(0)
 
-    # 8.5) Upload training blocks to S3
+    # 8.5) Upload training blocks to S3, concurrently with the processed chats
     if s3_client is not None:
-        logger.info(f"Uploading training blocks to S3 bucket {cfg.output.s3_bucket}...")
-        try:
-            s3_client.put_object(
-                Bucket=cfg.output.s3_bucket,
-                Key=f"{run_id}/data/train.jsonl",
-                Body="\n".join(training_block_lines),
-                Metadata=metadata_dict,
-            )
-            logger.info(
-                f"Successfully uploaded train.jsonl to s3://{cfg.output.s3_bucket}/{run_id}/data/train.jsonl"
-            )
-        except Exception as e:
-            logger.error(f"Failed to upload train.jsonl to S3: {e}")
-
-    # -------------------------------
-    # 9) Send request to fine-tuning service to start the training job
-    # -------------------------------
-    fine_tuning_url = os.getenv("FINE_TUNING_SERVICE_URL")
-
-    if not fine_tuning_url:
-        logger.error("FINE_TUNING_SERVICE_URL environment variable is not set.")
-        return chat_stats
-
-    # Send request to start fine-tuning
-    try:
-        response = requests.post(
-            fine_tuning_url,
-            json={"run_id": run_id},
-            headers={"Content-Type": "application/json"},
+        logger.info(f"Uploading training blocks to S3 bucket {s3_bucket}...")
+        uploads["train.jsonl"] = executor.submit(
+            _upload_payload,
+            s3_client,
+            training_blocks_file,
+            s3_bucket,
+            f"{run_id}/data/train.jsonl",
+            metadata_dict,
         )
+    else:
+        training_blocks_file.close()
 
-        if response.status_code == 200:
-            logger.info(f"Successfully queued fine-tuning job: {response.json()}")
-        else:
-            logger.error(
-                f"Failed to queue fine-tuning job: {response.status_code} - {response.text}"
-            )
-
-    except Exception as e:
-        logger.error(f"Error sending fine-tuning request: {e}")
+    # The fine-tuning service reads the uploaded data, so wait for both uploads first
+    for name, upload in uploads.items():
+        try:
+            upload.result()
+        except Exception as e:
+            logger.error(f"Failed to upload {name} to S3: {e}")
 
     return chat_stats
@@ -4,18 +4,28 @@ Utility functions for processing Telegram chat data.
 
 This module provides helper functions for:
 - Loading tokenizers (HuggingFace or TikToken) for text processing.
+- Counting tokens for many texts in a single batched tokenizer call.
 - Parsing date limits to filter messages.
+- Batch-parsing message timestamps into NumPy datetime arrays.
+- Finding conversation block boundaries from time gaps and token budgets.
 - Calculating statistics for processed chats and their blocks.
+- Sharing one S3 transfer configuration across all uploads.
 
 These utilities support preprocessing tasks for machine learning pipelines.
 """
 
 import logging
+import os
 import statistics
+import threading
+import warnings
 from datetime import datetime
 from typing import Dict, List, Optional, Union
 
+import numpy as np
 import tiktoken
+from boto3.s3.transfer import TransferConfig
+from numba import njit
 from transformers import AutoTokenizer, PreTrainedTokenizer, PreTrainedTokenizerFast
 
 from .models import Chat
@@ -25,6 +35,21 @@ AnyTokenizer = Union[PreTrainedTokenizer, PreTrainedTokenizerFast, tiktoken.Enco
 
 logger = logging.getLogger(__name__)
 
+# Uploads share one S3 client, whose botocore connection pool holds
+# `max_pool_connections` (default 10) connections. Up to two uploads run at once
+# (processed.json and train.jsonl), so their part uploads must fit in the pool
+# together, or urllib3 drops and re-opens connections ("Connection pool is full").
+S3_MAX_POOL_CONNECTIONS = 10
+S3_CONCURRENT_UPLOADS = 2
+
+# Upload large payloads in parallel multipart chunks via the S3 Transfer Manager;
+# payloads under the threshold are sent as a single PUT
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=S3_MAX_POOL_CONNECTIONS // S3_CONCURRENT_UPLOADS,
+)
+
 
 def load_tokenizer(model_name: str) -> AnyTokenizer:
     """Loads the specified tokenizer, falling back to TikToken.
@@ -38,6 +63,10 @@ def load_tokenizer(model_name: str) -> AnyTokenizer:
     Raises:
         RuntimeError: If no tokenizer could be loaded.
     """
+    # Let HuggingFace fast tokenizers spread batch encoding across all cores.
+    # The worker runs in a thread (never forked), so this is safe to enable.
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
     try:
         tokenizer = AutoTokenizer.from_pretrained(
             model_name,
@@ -66,6 +95,38 @@ def load_tokenizer(model_name: str) -> AnyTokenizer:
             raise RuntimeError("No valid tokenizer available.") from tiktoken_error
 
 
+def count_tokens_batch(
+    tokenizer: AnyTokenizer, texts: List[str], batch_size: int = 10_000
+) -> List[int]:
+    """Counts the tokens of every text with batched tokenizer calls.
+
+    Both HuggingFace fast tokenizers and TikToken encode batches natively in Rust
+    (multi-threaded), avoiding one Python-to-Rust round trip per text. Texts are
+    encoded in slices of `batch_size`, so only one slice's token ids are alive at once.
+
+    Args:
+        tokenizer: The tokenizer instance returned by `load_tokenizer`.
+        texts: The texts to tokenize.
+        batch_size: Maximum number of texts encoded per tokenizer call.
+
+    Returns:
+        The token count of each text, in the same order as `texts`.
+    """
+    counts: List[int] = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start : start + batch_size]
+        if isinstance(tokenizer, tiktoken.Encoding):
+            encoded = tokenizer.encode_batch(batch)
+        else:
+            # Same special-token handling as `tokenizer.encode`; only the ids are needed
+            encoded = tokenizer(
+                batch, return_attention_mask=False, return_token_type_ids=False
+            )["input_ids"]
+        counts.extend(len(ids) for ids in encoded)
+
+    return counts
+
+
 def parse_date_limit(date_limit_str: Optional[str]) -> Optional[datetime]:
     """Parses the ISO format date string into a datetime object.
 
@@ -100,6 +161,113 @@ def parse_date_limit(date_limit_str: Optional[str]) -> Optional[datetime]:
         return None
 
 
+# `warnings.catch_warnings` swaps process-wide state; jobs parse dates from several
+# threads, so serialise it to keep one thread from restoring another's filters
+_WARNINGS_LOCK = threading.Lock()
+
+
+def _has_utc_offset(date_string: str) -> bool:
+    """Checks whether an ISO format date string carries a UTC offset (e.g. "+08:00" or "Z")."""
+    time_part = date_string[10:]
+    return time_part.endswith("Z") or "+" in time_part or "-" in time_part
+
+
+def parse_timestamps(
+    date_strings: List[str], chat_name: Optional[str] = None
+) -> np.ndarray:
+    """Parses ISO format date strings into a NumPy `datetime64[us]` array.
+
+    The whole list is parsed in one C-level call. If any string is malformed or
+    carries a UTC offset, falls back to parsing one by one so that only the
+    offending entries are lost.
+
+    Unlike `datetime.fromisoformat`, NumPy cannot represent UTC offsets and converts
+    such dates to UTC, emitting only a `UserWarning`. That warning is raised as an
+    error during the bulk parse, and dates with an offset are rejected (NaT) with a
+    warning rather than shifted. Fractional seconds are kept.
+
+    Args:
+        date_strings: Message dates in ISO format (e.g. "2025-01-01T12:34:56").
+        chat_name: Name of the chat the dates belong to, used in warnings.
+
+    Returns:
+        An array of the parsed timestamps, with NaT for entries that could not be parsed.
+    """
+    prefix = f"[{chat_name}] " if chat_name else ""
+
+    with _WARNINGS_LOCK, warnings.catch_warnings():
+        # "no explicit representation of timezones available for np.datetime64"
+        warnings.simplefilter("error", UserWarning)
+        try:
+            return np.array(date_strings, dtype="datetime64[us]")
+        except (ValueError, UserWarning):
+            pass
+
+    parsed = np.full(len(date_strings), np.datetime64("NaT"), dtype="datetime64[us]")
+    for i, date_string in enumerate(date_strings):
+        if _has_utc_offset(date_string):
+            logger.warning(
+                f"{prefix}Skipping message with unsupported UTC offset in date: {date_string}"
+            )
+            continue
+        try:
+            parsed[i] = np.datetime64(date_string, "us")
+        except ValueError as e:
+            logger.warning(f"{prefix}Skipping message with unparseable date: {e}")
+    return parsed
+
+
+@njit
+def _reset_cumsum_breaks(
+    time_breaks: np.ndarray, token_counts: np.ndarray, max_tokens: int
+) -> np.ndarray:
+    """Marks where a running token sum (reset at every break) would exceed `max_tokens`."""
+    breaks = time_breaks.copy()
+    running_tokens = 0
+    for i in range(token_counts.shape[0]):
+        if breaks[i] or running_tokens + token_counts[i] > max_tokens:
+            breaks[i] = True
+            running_tokens = token_counts[i]
+        else:
+            running_tokens += token_counts[i]
+    return breaks
+
+
+def find_block_breaks(
+    timestamps: Union[np.ndarray, List[datetime]],
+    token_counts: List[int],
+    threshold_secs: float,
+    max_tokens: int,
+) -> np.ndarray:
+    """Finds the messages that start a new conversation block.
+
+    A message starts a new block if it is the first message, if it was sent more
+    than `threshold_secs` after the previous message, or if adding it would push the
+    running token count of the current block above `max_tokens`.
+
+    Args:
+        timestamps: Chronologically sorted message timestamps (datetime64 array or datetimes).
+        token_counts: Token count of each message.
+        threshold_secs: Maximum gap (in seconds) between messages in the same block.
+        max_tokens: Maximum number of tokens per block.
+
+    Returns:
+        A boolean array, True where a message starts a new block.
+    """
+    times = np.asarray(timestamps, dtype="datetime64[us]")
+    gaps_secs = np.diff(times) / np.timedelta64(1, "s")
+
+    time_breaks = np.empty(len(times), dtype=np.bool_)
+    time_breaks[:1] = True
+    time_breaks[1:] = gaps_secs > threshold_secs
+
+    # The token budget is a running sum that resets at every break, which plain
+    # NumPy cannot express; a compiled scan keeps it out of the interpreter.
+    return _reset_cumsum_breaks(
+        time_breaks, np.asarray(token_counts, dtype=np.int64), int(max_tokens)
+    )
+
+
 def calculate_chat_stats(
     chats: List[Chat], tokenizer: AnyTokenizer
 ) -> Dict[str, Union[int, float, Dict[str, int], None]]:
@@ -108,7 +276,8 @@ def calculate_chat_stats(
 
     Args:
         chats: A list of processed Chat objects containing messages and blocks.
-        tokenizer: The tokenizer instance used for processing.
+        tokenizer: The tokenizer instance used for processing. Only used for blocks
+            whose `token_count` has not already been set.
 
     Returns:
         A dictionary containing statistics:
@@ -147,9 +316,9 @@ def calculate_chat_stats(
 
     # --- Calculate Token Stats ---
     tokens_per_block_list = [
-        sum(
-            len(tokenizer.encode(msg.content)) for msg in block.messages
-        )  # Use tokenizer.encode directly
+        block.token_count
+        if block.token_count is not None
+        else sum(len(tokenizer.encode(msg.content)) for msg in block.messages)
         for block in all_blocks
     ]
     stats["min_tokens_per_block"] = min(tokens_per_block_list)